@@ -1,6 +1,8 @@
+import os
 import numexpr as ne
 import numpy as np
 from scipy import linalg
+from scipy.spatial import cKDTree
 import math
 import matplotlib.pyplot as plt
 import datetime
@@ -12,14 +14,19 @@ from openquake.hazardlib.correlation import BaseCorrelationModel
 from openquake.hazardlib.site import Site, SiteCollection
 from openquake.hazardlib.geo import Point
 from openquake.hazardlib.geo.geodetic import geodetic_distance
-from openquake.hazardlib.imt import from_string
+from openquake.hazardlib.imt import from_string, SA
 import time
 from matplotlib import cm
 from neicio.gmt import GMTGrid
 import time
+from joblib import Parallel, delayed
+from loop_numba import EARTH_RADIUS, _reduce_distance, _inc_stations_dist, _solve_point, _solve_bordered, _realize, _realize_many
 
+# Set LOOP_PROFILE in the environment to time every point of the inner loop
+DEBUG_TIMING = os.environ.get('LOOP_PROFILE')
 
-def main(var, r, voi, rand, cor_model, vs_corr):
+
+def main(var, r, voi, rand, cor_model, vs_corr, n_jobs=-1):
     """
     Main program for computing spatial correlation
     
@@ -34,16 +41,63 @@ def main(var, r, voi, rand, cor_model, vs_corr):
     vs_corr- boolean to determine if Vs30 are correlated. See
     JB2009
     intensity_factor- factor for non-native data
+    n_jobs- number of processes used for the rows, -1 uses all cores
     OUT: cor- grid of spatially correlated epsilon
     data- grid of ShakeMap data
     data_new- data with added spatial correlation
     grid_arr- array for storing grid indices for multiple realizations
     mu_arr- array for storing Sig21.T*Sig11inv for multiple realizations
+    offsets- start of each point in grid_arr and mu_arr
     sigma_arr- array for storing sigma for multiple realizations 
     """
     start = time.time()    
-    OL_time = 0
-    IL_time = 0
+
+    M = var['M']
+    N = var['N']
+
+    precomp = precompute(var, r, voi, cor_model, vs_corr, n_jobs)
+
+    realize_start = time.time()
+    X = realize(precomp, rand)
+    realize_time = time.time() - realize_start
+
+    DATA = var['data']
+    COR = np.reshape(X, [M,N]) #units epsilon
+
+    # COR*uncertaintydata is in ln(pctg), fused into one pass
+    DATA_NEW = ne.evaluate('DATA*exp(COR*unc)', local_dict={'DATA':DATA, 'COR':COR, 'unc':var['uncertaintydata']})
+
+    end = time.time() - start
+    print 'Total Time', end
+    print 'Realize time', realize_time
+
+    return {'cor':COR, 'data':DATA, 'data_new':DATA_NEW, 'grid_arr':precomp['grid_arr'], 'mu_arr':precomp['mu_arr'],
+            'offsets':precomp['offsets'], 'sigma_arr':precomp['sigma_arr']}
+
+
+
+def precompute(var, r, voi, cor_model, vs_corr, n_jobs=-1):
+    """
+    Computes everything that does not depend on the random variables: the
+    conditioning points, Sig21.T*Sig11inv and sigma of every point. Done once
+    and shared by all realizations
+    
+    INPUTS: 
+    var- variables dictionary from initialize function
+    r - radius
+    voi- variable of interest, i.e. PGA
+    cor_model- JB2009 or GA2010
+    vs_corr- boolean to determine if Vs30 are correlated. See
+    JB2009
+    n_jobs- number of processes used for the rows, -1 uses all cores
+    OUTPUTS: 
+    grid_arr- grid indices of the conditioning points of all points, concatenated
+    mu_arr- Sig21.T*Sig11inv of all points, concatenated. Stations are left out
+    since their value of x is zero
+    offsets- point num uses grid_arr and mu_arr[offsets[num]:offsets[num+1]]
+    sigma_arr- sigma of each point
+    """
+    start = time.time()    
 
     M = var['M']
     N = var['N']
@@ -55,191 +109,348 @@ def main(var, r, voi, rand, cor_model, vs_corr):
     else:
         CM = GA2010CorrelationModel()
 
-    # Initialize vector where data_new will be stored
-    X = np.zeros([M*N,1])
+    # voi is the same for every point, and JB2009 reduces to exp(-3h/b) which is evaluated directly
+    imt = from_string(voi)
+    if cor_model == 'JB2009':
+        b = JB2009_range(imt, vs_corr)
+    else:
+        b = None
+
+    # Locations as plain contiguous arrays, so the site collections are only accessed once
+    geo = {'SM_lons':np.ascontiguousarray(var['site_collection_SM'].lons, dtype=np.float64),
+           'SM_lats':np.ascontiguousarray(var['site_collection_SM'].lats, dtype=np.float64),
+           'ST_lons':np.ascontiguousarray(var['site_collection_station'].lons[0:K], dtype=np.float64),
+           'ST_lats':np.ascontiguousarray(var['site_collection_station'].lats[0:K], dtype=np.float64)}
+
+    # Spatial index of the stations on the unit sphere, where the radius becomes a chord length. The chord is padded
+    # slightly so rounding cannot drop a station, the exact distances are checked per point
+    if K > 0:
+        geo['ST_tree'] = cKDTree(unit_xyz(geo['ST_lons'], geo['ST_lats']))
+    else:
+        geo['ST_tree'] = None
+    geo['chord_r'] = 2*np.sin(min(r/(2*EARTH_RADIUS), np.pi/2))*(1+1e-9)
 
-    # Initialize vectors for storing data for multiple realizations
-    grid_arr = [None] * (M*N)
-    mu_arr = [None] * (M*N)
-    sigma_arr = np.zeros([M*N,1])
-    rand_arr = np.zeros([M*N,1])
-    
     # Get spcing of horozontal and vertical points
-    ld  = set_up_grid_dist(M,N,var['site_collection_SM'])
+    ld  = set_up_grid_dist(M,N,geo)
     pre_loop_time = time.time() - start
 
+    # The distance matrices and correlations of a row do not depend on X, so the rows are computed in parallel
+    rows = Parallel(n_jobs=n_jobs, backend='loky', batch_size='auto', mmap_mode='r')(
+        delayed(_process_row)(i, r, imt, b, N, ld, CM, geo)
+        for i in range(0,M))
+
+    # Store the conditioning points of all points in flat arrays, with offsets to where each point starts
+    offsets = np.zeros(M*N+1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.concatenate([rows[i]['nnz'] for i in range(0,M)]))
+
+    grid_arr = np.empty(offsets[-1], dtype=np.int32)
+    mu_arr = np.empty(offsets[-1], dtype=np.float32)
+    sigma_arr = np.zeros(M*N)
+
+    OL_time = 0
+    IL_time = 0
     for i in range(0,M):
-        OL_start = time.time()
-        
-        # Find the number of points in radius horozontally and vertically for each row
-        vhva = calc_vert_hor(i, r, ld['l'], ld['d'])
+        grid_arr [offsets[i*N]:offsets[(i+1)*N]] = rows[i]['grid_arr']
+        mu_arr   [offsets[i*N]:offsets[(i+1)*N]] = rows[i]['mu_arr']
+        sigma_arr[i*N:(i+1)*N] = rows[i]['sigma_arr']
+        OL_time += rows[i]['OL_time']
+        IL_time += rows[i]['IL_time']
+
+    end = time.time() - start
+    print 'Precompute Time', end
+    print 'Pre loop Time', pre_loop_time
+    if DEBUG_TIMING:
+        print 'Inner loop time', IL_time
+        print 'Outer loop time', OL_time
+
+    return {'grid_arr':grid_arr, 'mu_arr':mu_arr, 'offsets':offsets, 'sigma_arr':sigma_arr}
+
+
+
+def realize(precomp, rand):
+    """
+    Computes realizations of the spatially correlated epsilon. Each
+    realization is sequential over the points, several realizations are
+    computed in parallel
+    
+    INPUTS: 
+    precomp- output of precompute
+    rand- array of random variables, or one row of random variables per
+    realization
+    OUTPUTS: 
+    X- spatially correlated epsilon at each point, one row per realization
+    if rand is 2d
+    """
+    grid_arr = precomp['grid_arr']
+    mu_arr = precomp['mu_arr']
+    offsets = precomp['offsets']
+    sigma_arr = precomp['sigma_arr']
+
+    rand = np.ascontiguousarray(rand, dtype=np.float64)
+    if rand.ndim == 2:
+        return _realize_many(grid_arr, mu_arr, offsets, sigma_arr, rand)
+
+    X = np.zeros(np.size(sigma_arr))
+    _realize(grid_arr, mu_arr, offsets, sigma_arr, rand, X)
+
+    return X
+
+
+
+def _process_row(i, r, imt, b, N, ld, CM, geo):
+    """
+    Computes the correlation for every point in a row. Only depends on the grid
+    and station locations, so rows may be computed independently
+    
+    INPUTS: 
+    i- current row
+    r- radius
+    imt- intensity measure type of the variable of interest
+    b- range of the JB2009 correlation model, None for other models
+    N- number of points in row
+    ld- vertical and horozontal spacing from set_up_grid_dist
+    CM- correlation model from correlation in oq-hazardlib
+    geo- lons and lats of the ShakeMap points and stations, and the station spatial index
+    OUTPUTS: 
+    grid_arr- grid indices of the conditioning points of the row, concatenated
+    mu_arr- Sig21.T*Sig11inv of the grid points of the row, concatenated
+    nnz- number of conditioning points of each point in the row
+    sigma_arr- sigma of each point in the row
+    OL_time, IL_time- time spent per row and per point, IL_time is only measured if DEBUG_TIMING is set
+    """
+    OL_start = time.time()
+    IL_time = 0
+
+    grid_arr = [None] * N
+    mu_arr = [None] * N
+    sigma_arr = np.zeros(N)
 
-        # Calculate the full distance matrix for each row
-        dist = calc_full_dist(i, vhva['vert'], vhva['hor'], N, var['site_collection_SM'])
-        first_time_per_row = 1
-        OL_time += time.time() - OL_start
+    # Find the number of points in radius horozontally and vertically for each row
+    vhva = calc_vert_hor(i, r, ld['l'], ld['d'])
 
-        for j in range(0,N):
+    # Calculate the full distance matrix for each row
+    dist = calc_full_dist(i, vhva['vert'], vhva['hor'], N, geo)
+
+    # Every point of the row uses a submatrix of the full distance matrix, so evaluate the correlation model once
+    corr_row = np.ascontiguousarray(get_correlation(dist['distance_matrix'], imt, CM, b), dtype=np.float32)
+    corr_buf = np.empty(np.shape(corr_row), dtype=np.float32)
+
+    # Candidate stations for every point in the row, exact distances are checked in inc_stations
+    if geo['ST_tree'] is None:
+        sta_cand = [[] for j in range(0,N)]
+    else:
+        sta_cand = geo['ST_tree'].query_ball_point(unit_xyz(geo['SM_lons'][i*N:(i+1)*N], geo['SM_lats'][i*N:(i+1)*N]),
+                                                   geo['chord_r'])
+
+    # The full distance matrix is the reduced distance matrix of every point away from the edges of the row, so
+    # calculate the base case once and reuse it for all of those points. Points with stations extend its factor
+    if np.size(dist['grid_indices']) > 1:
+        base = calculate_corr(corr_row)
+
+    print 'Starting step:', i*N
+
+    for j in range(0,N):
+        if DEBUG_TIMING:
             IL_start = time.time()
-            num = i*N+j
-            
-            # Find the reduced distance matrix 
-            dist_calc = reduce_distance(j, vhva['vert'], vhva['hor'], vhva['added_vert'], N, dist['distance_matrix'], dist['grid_indices'])
-
-            # Include stations in distance matrix and find the indices of the points within the radius
-            out = inc_stations(j, i, N, K, r, var['site_collection_SM'], var['site_collection_station'], 
-                               dist_calc['dist_mat'], X, dist_calc['inc_ind'])
-
-            if np.size(dist_calc['inc_indices']) == 1:
-                # no conditioning points, correlation value is random
-                X[num] = rand[num]
-
-                # Store for multiple realizations
-                grid_arr [num] = np.zeros(0)
-                mu_arr   [num] = np.zeros(0)
-                sigma_arr[num] = 1
-                rand_arr [num] = X[num]
+
+        # Find the reduced correlation matrix 
+        dist_calc = reduce_distance(j, vhva['vert'], vhva['hor'], vhva['added_vert'], N, corr_row,
+                                    dist['grid_indices'], corr_buf)
+
+        # Include stations in correlation matrix
+        out = inc_stations(j, i, N, r, geo, sta_cand[j], dist_calc['corr_mat'], dist_calc['inc_ind'], imt, CM, b)
+
+        if np.size(dist_calc['inc_indices']) == 1:
+            # no conditioning points, correlation value is random
+            grid_arr [j] = np.zeros(0, dtype=int)
+            mu_arr   [j] = np.zeros(0)
+            sigma_arr[j] = 1
+        else:
+            # Check if reduced distance matrix is full distance matrix
+            full = (vhva['vert'] == 1 and dist_calc['num_indices'] == vhva['hor']+1)or(vhva['vert'] != 1 and \
+                   dist_calc['num_indices'] == 2*vhva['hor']+1)
+            if full and np.size(out['inc_sta_indices']) == 0:
+                corr = base
+            elif full and base['L'] is not None:
+                corr = calculate_corr_stations(out['corr_mat'], np.size(out['inc_sta_indices']), base)
             else:
-                # Check if reduced distance matrix is full distance matrix
-                if ((vhva['vert'] == 1 and dist_calc['num_indices'] == vhva['hor']+1)or(vhva['vert'] != 1 and \
-                       dist_calc['num_indices'] == 2*vhva['hor']+1)) and (np.size(out['inc_sta_indices']) == 0):
-                    # If this is the first full distance matrix per row, calculate base case
-                    if first_time_per_row == 1:
-                        base = calculate_corr(out['dist_mat'], voi, CM)
-                        first_time_per_row = 0
-
-                    mu  = base['Sig12'].T*base['Sig11inv']*out['x']
-                    rand_num = rand[num]
-                    X[num] = mu+rand_num*base['R']
-
-                    # Store for multiple realizations
-                    grid_arr [num] = dist_calc['inc_ind'][0:-1]
-                    mu_arr   [num] = base['Sig12'].T*base['Sig11inv']
-                    sigma_arr[num] = base['R']
-                    rand_arr [num] = rand_num
-
-                else:
-                    other = calculate_corr(out['dist_mat'], voi, CM)
-                    mu = other['Sig12'].T*other['Sig11inv']*out['x']
-                    rand_num = rand[num]
-                    X[num] = mu+rand_num*other['R']
-
-                    # Store for multiple realizations                                                                             
-                    grid_arr [num] = dist_calc['inc_ind'][0:-1]
-                    mu_arr   [num] = other['Sig12'].T*other['Sig11inv']
-                    sigma_arr[num] = other['R']
-                    rand_arr [num] = rand_num
+                corr = calculate_corr(out['corr_mat'])
 
-            IL_time += time.time() - IL_start
-            if np.mod(i*N+j,5000) == 0:
-                print 'Finishing step:', i*N+j
+            # Stations come first in alpha and have a value of zero in x, so only the grid points are kept
+            grid_arr [j] = dist_calc['inc_ind'][0:-1]
+            mu_arr   [j] = corr['alpha'][np.size(out['inc_sta_indices']):]
+            sigma_arr[j] = corr['R']
 
-    DATA = var['data']
-    COR = np.reshape(X, [M,N]) #units epsilon
+        if DEBUG_TIMING:
+            IL_time += time.time() - IL_start
 
-    X = np.multiply(COR, var['uncertaintydata']) # ln(pctg)
-    DATA_NEW = np.multiply(DATA,np.exp(X))
+    OL_time = time.time() - OL_start - IL_time
 
-    end = time.time() - start
-    print 'Total Time', end
-    print 'Pre loop Time', pre_loop_time
-    print 'Inner loop time', IL_time
-    print 'Outer loop time', OL_time
+    nnz = np.array([np.size(inds) for inds in grid_arr])
 
-    return {'cor':COR, 'data':DATA, 'data_new':DATA_NEW, 'grid_arr':grid_arr, 'mu_arr':mu_arr, 'sigma_arr':sigma_arr}
+    return {'grid_arr':np.concatenate(grid_arr), 'mu_arr':np.concatenate(mu_arr), 'nnz':nnz, 'sigma_arr':sigma_arr,
+            'OL_time':OL_time, 'IL_time':IL_time}
 
 
 
-def calculate_corr(dist_mat, voi, CM):
+def calculate_corr(correlation_model):
     """
-    Calculates correlation model for distance matrix and voi
+    Partitions the correlation matrix of a point and solves for its weights
     
     INPUTS: 
-    dist_mat- reduced distance matrix
-    voi- variable of interest
-    JB_cor_model- correlation model from correlation in oq-hazardlib
+    correlation_model- reduced correlation matrix, current point last
     OUTPUTS: 
-    Sig12, Sig11inv- partitions of correlation matrix
+    alpha- Sig12.T*Sig11inv, from the partitions of correlation matrix
     R - Sqrt of sigma
+    L, y- Cholesky factor of Sig11 and L^-1*Sig12, None if Sig11 could not be factored
     """
-    correlation_model = CM._get_correlation_model(dist_mat, from_string(voi))
+    # Single precision is plenty for the correlation model, but nearly coincident points can make Sig11 too ill
+    # conditioned to factor in float32, so retry in float64 before giving up on Cholesky
+    alpha, R, L, y, info = _solve_point(np.ascontiguousarray(correlation_model, dtype=np.float32))
+    if info != 0:
+        correlation_model = np.ascontiguousarray(correlation_model, dtype=np.float64)
+        alpha, R, L, y, info = _solve_point(correlation_model)
+
+    if info != 0:
+        # Sig11 is not numerically positive definite, fall back to least squares
+        Sig11 = correlation_model[0:-1, 0:-1]
+        Sig12 = correlation_model[0:-1, -1]
+        alpha = np.linalg.lstsq(Sig11, Sig12, rcond=None)[0]
+        R = np.sqrt(correlation_model[-1, -1] - np.dot(Sig12, alpha))
+        L = None
+        y = None
+
+    return {'alpha':alpha, 'R':R, 'L':L, 'y':y}
+
+
+def calculate_corr_stations(correlation_model, n_sta, base):
+    """
+    Calculates the correlation for a point whose grid points are those of the
+    base case, with stations added in front. Only the station rows of the
+    correlation matrix are used, and the base Cholesky factor is extended
+    with them instead of factoring the whole matrix again
     
-    Sig11 = np.mat(correlation_model[0:-1, 0:-1])
-    Sig12 = np.mat(correlation_model[0:-1, -1]).T
-    Sig22 = np.mat(correlation_model[-1,-1])
+    INPUTS: 
+    correlation_model- reduced correlation matrix, stations first
+    n_sta- number of stations included
+    base- output of calculate_corr for the grid points only
+    OUTPUTS: 
+    alpha- Sig12.T*Sig11inv, from the partitions of correlation matrix
+    R - Sqrt of sigma
+    """
+    sta_corr = np.ascontiguousarray(correlation_model[0:n_sta, :], dtype=base['L'].dtype)
+    alpha, R, info = _solve_bordered(base['L'], base['y'], base['R'], sta_corr[:, 0:n_sta],
+                                     sta_corr[:, n_sta:-1], sta_corr[:, -1])
+    if info != 0:
+        # A station is too close to a grid point to extend the factor, start over
+        return calculate_corr(correlation_model)
 
-    Sig11inv = np.mat(np.linalg.pinv(Sig11))
-    sigma = Sig22 - (Sig12.T*Sig11inv*Sig12)
+    return {'alpha':alpha, 'R':R}
 
-    R = np.sqrt(sigma)
 
-    return {'Sig12':Sig12, 'Sig11inv':Sig11inv, 'R':R}
+def get_correlation(dist_mat, imt, CM, b):
+    """
+    Evaluates the correlation model on a matrix of distances
+    
+    INPUTS: 
+    dist_mat- distance matrix
+    imt- intensity measure type of the variable of interest
+    CM- correlation model from correlation in oq-hazardlib
+    b- range of the JB2009 correlation model, None for other models
+    OUTPUTS: 
+    correlation_model- correlation of each distance
+    """
+    if b is None:
+        return CM._get_correlation_model(dist_mat, imt)
+    else:
+        return ne.evaluate('exp(c*dist_mat)', local_dict={'dist_mat':dist_mat, 'c':np.float32(-3.0/b)})
 
 
-def inc_stations(j,i,N,K,r,site_collection_SM, site_collection_station, dist_mat, X, inc_ind):
+def JB2009_range(imt, vs_corr):
+    """
+    Range of the JB2009 correlation model, rho = exp(-3h/b). Same coefficients
+    as JB2009CorrelationModel in oq-hazardlib
+    
+    INPUTS: 
+    imt- intensity measure type of the variable of interest
+    vs_corr- boolean to determine if Vs30 are correlated
+    OUTPUTS: 
+    b- range in km
+    """
+    if isinstance(imt, SA):
+        period = imt.period
+    else:
+        period = 0
+
+    if vs_corr:
+        if period < 1:
+            b = 8.5 + 17.2*period
+        else:
+            b = 22.0 + 3.7*period
+    else:
+        b = 40.7 - 15.0*period
+
+    return b
+
+
+def inc_stations(j,i,N,r,geo, sta_cand, corr_mat, inc_ind, imt, CM, b):
     """
     If there are stations included within the radius for a point, this function will add those stations to the 
-    distance matrix and determine the array of points included in the radius, x
+    correlation matrix
     
     INPUTS: 
     i,j- current points row and column 
-    N,K - number of points in row and total number of stations
+    N- number of points in row
     r- radius 
-    site_collection_SM/station- site collections for ShakeMap and station data
-    dist_mat- reduced distance matrix
-    X- array of previously calculated correlation values
+    geo- lons and lats of the ShakeMap points and stations
+    sta_cand- indices of the stations found near the point by the spatial index
+    corr_mat- reduced correlation matrix
     inc_ind- indices of included points
-    inc_indices- total number of points in the top most row of distance matrix
+    imt- intensity measure type of the variable of interest
+    CM- correlation model from correlation in oq-hazardlib
+    b- range of the JB2009 correlation model, None for other models
     OUTPUTS: 
-    dist_mat- reduced distance matrix, modified to include stations
-    x- array of points in X included in radius and stations included 
+    corr_mat- reduced correlation matrix, modified to include stations
     inc_sta_indices- indices of stations included in the radius
     """
     
-    # Compute the distances for all stations to the grid point we're looking at
-    dist_sta_sit = np.array(geodetic_distance(site_collection_SM.lons[j+i*N], site_collection_SM.lats[j+i*N],
-                                              site_collection_station.lons[0:K], site_collection_station.lats[0:K]))
-        
-    # Find which of those stations are in the radius we are considering
-    inc_sta_indices = np.where(dist_sta_sit < r)[0]
+    # Compute the distances for the candidate stations to the grid point we're looking at, and find which of those
+    # stations are in the radius we are considering
+    sta_cand = np.sort(np.asarray(sta_cand, dtype=np.int64))
+    dist_sta_sit = np.empty(np.size(sta_cand))
+    inc_sta_indices = sta_cand[_inc_stations_dist(geo['SM_lons'][j+i*N], geo['SM_lats'][j+i*N],
+                                                  geo['ST_lons'][sta_cand], geo['ST_lats'][sta_cand], r, dist_sta_sit)]
     if np.size(inc_sta_indices) != 0:
-        sta_to_sta_dist = np.zeros([np.size(inc_sta_indices), np.size(inc_sta_indices)])
-        sta_to_grd_dist = np.zeros([np.size(inc_sta_indices), np.size(inc_ind)])
-
-        iinds = np.array(inc_ind).T[0]
-        # Calculate distance between each included station and all included grid points, then calculate the distance
-        # from each included station to every other included station
-        for eta in range(0, np.size(inc_sta_indices)):
-            sta_to_grd_dist[eta, :] = geodetic_distance(
-                site_collection_station.lons[inc_sta_indices[eta]], site_collection_station.lats[inc_sta_indices[eta]], 
-                site_collection_SM.lons[iinds], site_collection_SM.lats[iinds])
-            sta_to_sta_dist[eta, eta+1:] = geodetic_distance(
-                site_collection_station.lons[inc_sta_indices[eta]], site_collection_station.lats[inc_sta_indices[eta]],
-                site_collection_station.lons[inc_sta_indices[eta+1:]], site_collection_station.lats[inc_sta_indices[eta+1:]])
-            
-        sta_to_sta_dist = sta_to_sta_dist + sta_to_sta_dist.T
-        station_distance_matrix = np.concatenate((sta_to_sta_dist, sta_to_grd_dist), axis=1)
-                        
-        # Concatenate the station distance matrix with the modified distance matrix, dist_mat
-        dist_mat = np.concatenate((station_distance_matrix[:, np.size(inc_sta_indices):], dist_mat), axis=0)
-        dist_mat = np.concatenate((station_distance_matrix.T, dist_mat), axis=1)
-            
-        # x: vector of previously calculated covariance values
-        x = np.concatenate((np.zeros([np.size(inc_sta_indices),1]),X[inc_ind,0]), axis = 0)
-        x = np.mat(x[0:-1])
-
-    else:
-        # x: vector of previously calculated covariance values
-        x = X[inc_ind,0]
-        x = np.mat(x[0:-1])
+        s_lons = geo['ST_lons'][inc_sta_indices]
+        s_lats = geo['ST_lats'][inc_sta_indices]
+
+        # Calculate distance between each included station and all included grid points, and from each included
+        # station to every other included station
+        n = np.shape(corr_mat)[0]
+        k = np.size(inc_sta_indices)
+        sta_dist = np.empty([k, k+n], dtype=np.float32)
+        sta_dist[:, 0:k] = geodetic_distance(s_lons[:,None], s_lats[:,None], s_lons[None,:], s_lats[None,:])
+        sta_dist[:, k:] = geodetic_distance(s_lons[:,None], s_lats[:,None],
+                                            geo['SM_lons'][inc_ind][None,:], geo['SM_lats'][inc_ind][None,:])
+
+        # Only the station rows need the correlation model, the grid block comes from the row's correlation matrix
+        sta_corr = get_correlation(sta_dist, imt, CM, b)
+
+        # Stations come first in the modified correlation matrix, corr_mat. The blocks are written straight into it
+        out = np.empty([n+k, n+k], dtype=np.float32)
+        out[0:k, :] = sta_corr
+        out[k:, 0:k] = sta_corr[:, k:].T
+        out[k:, k:] = corr_mat
+        corr_mat = out
     
-    return {'dist_mat':dist_mat, 'x':x, 'inc_sta_indices':inc_sta_indices}
+    return {'corr_mat':corr_mat, 'inc_sta_indices':inc_sta_indices}
 
 
 
-def reduce_distance(j, vert, hor, added_vert, N, distance_matrix, grid_indices):
+def reduce_distance(j, vert, hor, added_vert, N, corr_row, grid_indices, corr_buf):
     """
-    Find which columns/rows in the distance matrix to keep
+    Find which columns/rows in the distance matrix to keep, and keep them in
+    the correlation matrix of the row
     
     INPUTS: 
     j- points column
@@ -247,88 +458,45 @@ def reduce_distance(j, vert, hor, added_vert, N, distance_matrix, grid_indices):
     hor- number of columns included in radius
     added_vert- number of rows in between first row and first included row 
     N- number of points in row
-    distance_matrix- full distance matrix
+    corr_row- correlation matrix of the full distance matrix
     grid_indices- indices included in full distance matrix
+    corr_buf- preallocated buffer the size of corr_row
     OUTPUTS: 
-    dist_mat- reduced distance matrix
-    inc_indices- number of points in top most row of dist_mat
-    inc_ind - indices of points included in dist_mat
+    corr_mat- reduced correlation matrix
+    inc_indices- number of points in top most row of corr_mat
+    inc_ind - indices of points included in corr_mat
     num_indices- number of points in top most row of distance_matrix
     """
-    inc_ind = [None]*(vert*(2*hor+1))
-    n_grid_indices = 0
-    num_indices = 0
-    
-    if j < hor:
-        # On left end of grid
-        inc_indices = range(0,np.size(grid_indices))
-        if vert == 1:
-            num_indices = (j+1)
-            inc_indices = np.where(np.mod(inc_indices,hor+1) >=hor+1 - num_indices)
-        else:
-            num_indices = (j+hor+1)
-            inc_indices = np.where(np.mod(inc_indices,2*hor+1) >=2*hor+1 - num_indices)
-            
-        for k in range(0,vert):
-            if k == vert-1:
-                for eta in range(0,j+1):
-                    inc_ind[n_grid_indices] = [eta+N*k+ N*added_vert]
-                    n_grid_indices += 1
-            else:
-                for eta in range(0,j+hor+1):
-                    inc_ind[n_grid_indices] = [eta+N*k+N*added_vert]
-                    n_grid_indices += 1
-        del inc_ind[n_grid_indices:]
-            
-    elif j > N-hor-1:
-        # On right end of grid
-        inc_indices = range(0,np.size(grid_indices))
-        if vert == 1:
-            num_indices = (1+hor)
-            inc_indices = np.where(np.mod(inc_indices,hor+1) >=hor+1 - num_indices)
-        else:
-            num_indices = (N - j+hor)
-            inc_indices = np.where(np.mod(inc_indices,2*hor+1) <=num_indices-1)
-        for k in range(0,vert):
-            if k == vert-1:
-                for eta in range(j-hor,j+1):
-                    inc_ind[n_grid_indices] = [eta+N*k+N*added_vert]
-                    n_grid_indices += 1
-            else:
-                for eta in range(j-hor,N):
-                    inc_ind[n_grid_indices] = [eta+N*k+N*added_vert]
-                    n_grid_indices += 1
-        del inc_ind[n_grid_indices:]
-            
+    # Columns of the grid kept for the rows above the point, clipped at the left and right ends of the grid. The
+    # point's own row only keeps the columns up to the point
+    lo = max(j-hor, 0)
+    hi = min(j+hor, N-1)
+    n_upper = (vert-1)*(hi-lo+1)
+
+    # inc_ind: grid indices of the kept points
+    rows = np.arange(added_vert, added_vert+vert)
+    inc_ind = (N*rows[:,None] + np.arange(lo, hi+1)[None,:]).ravel()[0:n_upper+j-lo+1]
+
+    # inc_indices: positions of the kept points in the full distance matrix, whose rows have 2*hor+1 points centered
+    # on the current column
+    inc_indices = ((2*hor+1)*np.arange(vert)[:,None] + np.arange(lo-j+hor, hi-j+hor+1)[None,:]).ravel()
+    inc_indices = inc_indices[0:n_upper+j-lo+1]
+
+    if vert == 1:
+        num_indices = j-lo+1
     else:
-        # In the middle of the grid, all points included
-        inc_indices = range(0,np.size(grid_indices))
-        if vert == 1:
-            num_indices = (1+hor)
-            inc_indices = np.where(np.mod(inc_indices,hor+1) >=hor+1 - num_indices)
-        else:
-            num_indices = (2*hor+1)
-            inc_indices = np.where(np.mod(inc_indices,2*hor+1) >=2*hor+1 - num_indices)
-        for k in range(0,vert):
-            if k == vert-1:
-                for eta in range(j-hor,j+1):
-                    inc_ind[n_grid_indices] = [eta+N*k+N*added_vert]
-                    n_grid_indices += 1
-            else:
-                for eta in range(j-hor,j+hor+1):
-                    inc_ind[n_grid_indices] = [eta+N*k+N*added_vert]
-                    n_grid_indices += 1
-        del inc_ind[n_grid_indices:]
-
-    inc_indices = np.array(inc_indices).flatten()
+        num_indices = hi-lo+1
         
-    # dist_mat: the distance matrix modified for the current point
-    dist_mat = distance_matrix[:,inc_indices]
-    dist_mat = dist_mat[inc_indices, :]
+    # corr_mat: the correlation matrix modified for the current point. Away from the edges this is the correlation
+    # matrix of the row, so skip the copy
+    if np.size(inc_indices) == np.size(grid_indices):
+        corr_mat = corr_row
+    else:
+        corr_mat = _reduce_distance(corr_row, inc_indices, corr_buf)
 
-    return {'dist_mat':dist_mat, 'inc_indices':inc_indices, 'inc_ind':inc_ind, 'num_indices':num_indices}
+    return {'corr_mat':corr_mat, 'inc_indices':inc_indices, 'inc_ind':inc_ind, 'num_indices':num_indices}
 
-def calc_full_dist(row, vert, hor, N, site_collection_SM):
+def calc_full_dist(row, vert, hor, N, geo):
     """
     Calculates full distance matrix. Called once per row.
     
@@ -336,39 +504,40 @@ def calc_full_dist(row, vert, hor, N, site_collection_SM):
     vert- number of included rows
     hor- number of columns within radius 
     N- number of points in row
-    site_collection_SM- site collection for ShakeMap data
+    geo- lons and lats of the ShakeMap points and stations
     OUTPUTS: 
     grid_indices- indices of points included in distance matrix
     distance_matrix- full distance matrix
     """
-    # gathers indices for full distance matrix for each row
-    grid_indices = [None]*((vert)*(2*hor+1))
-    n_grid_indices = 0
-    for k in range(row-vert+1, row+1):
-        if k == row:
-            for j in range(0,hor+1):
-                grid_indices[n_grid_indices] = j + N*k
-                n_grid_indices += 1
-        else:
-            for j in range(0,2*hor+1):
-                grid_indices[n_grid_indices] = j + N*k
-                n_grid_indices += 1
-    del grid_indices[n_grid_indices:]
+    # gathers indices for full distance matrix for each row, the last row stops at the current column
+    rows = np.arange(row-vert+1, row+1)
+    grid_indices = (N*rows[:,None] + np.arange(2*hor+1)[None,:]).ravel()[0:(vert-1)*(2*hor+1)+hor+1]
 
-    distance_matrix = np.zeros([np.size(grid_indices), np.size(grid_indices)])
-    
-    # Create full distance matrix for row
-    for k in range(0, np.size(grid_indices)):
-        distance_matrix[k, k:] = geodetic_distance(
-                   site_collection_SM.lons[grid_indices[k ]], site_collection_SM.lats[grid_indices[k]],
-                   site_collection_SM.lons[grid_indices[k:]], site_collection_SM.lats[grid_indices[k:]]).flatten()
-    
-    distance_matrix = distance_matrix + distance_matrix.T
+    # Create full distance matrix for row, broadcasting the points against each other in one call
+    lons = geo['SM_lons'][grid_indices]
+    lats = geo['SM_lats'][grid_indices]
+    distance_matrix = geodetic_distance(lons[:,None], lats[:,None], lons[None,:], lats[None,:])
+    distance_matrix = distance_matrix.astype(np.float32, copy=False)
 
     return {'grid_indices':grid_indices, 'distance_matrix':distance_matrix}
 
 
 
+def unit_xyz(lons, lats):
+    """
+    Converts locations to points on the unit sphere
+    
+    INPUTS: 
+    lons, lats- locations in degrees
+    OUTPUTS: 
+    xyz- array with one row of x,y,z per location
+    """
+    lons = np.radians(lons)
+    lats = np.radians(lats)
+    return np.column_stack([np.cos(lats)*np.cos(lons), np.cos(lats)*np.sin(lons), np.sin(lats)])
+
+
+
 def calc_vert_hor(i, r, l, d):
     """
     Calculates the number of vertical of horozontal points in the full distance matrix
@@ -393,22 +562,22 @@ def calc_vert_hor(i, r, l, d):
 
     return {'vert':vert, 'hor':hor, 'added_vert':added_vert}
 
-def set_up_grid_dist(M,N, site_collection_SM):
+def set_up_grid_dist(M,N, geo):
     """
     Calculates the vertical and horozontal spacing between points for each row
     
     INPUTS: 
     M,N- number of points in grid vertically and horozontally
-    site_collection_SM- site collection for ShakeMap data
+    geo- lons and lats of the ShakeMap points and stations
     OUTPUTS: 
     l,d- vectors of distances between points vertically and horozontally
     """
-    l = np.zeros([M-1])
-    d = np.zeros([M])
-    
+    lons = geo['SM_lons']
+    lats = geo['SM_lats']
+
     # Calculate vertical and horozonal spacing between points for each row
-    l[:] = geodetic_distance(site_collection_SM.lons[range(N,N*M,N)],   site_collection_SM.lats[range(N,N*M,N)],
-                             site_collection_SM.lons[range(0,N*M-N,N)], site_collection_SM.lats[range(0,N*M-N,N)])
-    d[:] = geodetic_distance(site_collection_SM.lons[range(0, M*N, N)], site_collection_SM.lats[range(0, M*N, N)],
-                             site_collection_SM.lons[range(1, M*N, N)], site_collection_SM.lats[range(1, M*N, N)])
+    l = geodetic_distance(lons[N:N*M:N],   lats[N:N*M:N],
+                          lons[0:N*M-N:N], lats[0:N*M-N:N])
+    d = geodetic_distance(lons[0:M*N:N], lats[0:M*N:N],
+                          lons[1:M*N:N], lats[1:M*N:N])
     return {'l':l, 'd':d}
@@ -0,0 +1,275 @@
+import numpy as np
+import llvmlite.binding as ll
+from numba import njit, generated_jit, prange, types
+from numba.extending import get_cython_function_address
+
+# Same value used by openquake.hazardlib.geo.geodetic
+EARTH_RADIUS = 6371.0
+
+
+def _lapack(name, nargs):
+    """
+    Binds a routine from scipy.linalg.cython_lapack so it can be called
+    directly from nopython code. Registering the symbol by name, instead of
+    using a ctypes pointer, keeps the callers cacheable
+    """
+    symbol = 'cython_lapack_' + name
+    ll.add_symbol(symbol, get_cython_function_address('scipy.linalg.cython_lapack', name))
+    return types.ExternalFunction(symbol, types.void(*([types.voidptr]*nargs)))
+
+_spotrf = _lapack('spotrf', 5)
+_dpotrf = _lapack('dpotrf', 5)
+_strtrs = _lapack('strtrs', 10)
+_dtrtrs = _lapack('dtrtrs', 10)
+
+# LAPACK character arguments
+_U = 85
+_N = 78
+_T = 84
+
+
+@njit(cache=True)
+def _reduce_distance(distance_matrix, inc_indices, out):
+    """
+    Copies the rows/columns of the full distance (or correlation) matrix kept
+    for the current point
+
+    INPUTS:
+    distance_matrix- full distance or correlation matrix for the row
+    inc_indices- indices of distance_matrix to keep
+    out- preallocated buffer, at least as large as distance_matrix
+    OUTPUTS:
+    dist_mat- reduced matrix, a view into out
+    """
+    n = inc_indices.shape[0]
+    for a in range(n):
+        ia = inc_indices[a]
+        for b in range(n):
+            out[a, b] = distance_matrix[ia, inc_indices[b]]
+    return out[0:n, 0:n]
+
+
+@njit(cache=True)
+def _inc_stations_dist(lon, lat, sta_lons, sta_lats, r, out):
+    """
+    Computes the geodetic distance from a grid point to every station and finds
+    the stations within the radius
+
+    INPUTS:
+    lon, lat- location of the grid point
+    sta_lons, sta_lats- locations of the stations
+    r- radius
+    out- preallocated buffer of length K for the distances
+    OUTPUTS:
+    inc_sta_indices- indices of stations included in the radius
+    """
+    K = sta_lons.shape[0]
+    inc_sta_indices = np.empty(K, dtype=np.int64)
+    n_inc = 0
+    lon1 = np.radians(lon)
+    lat1 = np.radians(lat)
+    for k in range(K):
+        lon2 = np.radians(sta_lons[k])
+        lat2 = np.radians(sta_lats[k])
+        h = np.sin((lat1 - lat2) / 2.0) ** 2.0 \
+            + np.cos(lat1) * np.cos(lat2) * np.sin((lon1 - lon2) / 2.0) ** 2.0
+        out[k] = 2.0 * EARTH_RADIUS * np.arcsin(np.sqrt(min(max(h, -1.0), 1.0)))
+        if out[k] < r:
+            inc_sta_indices[n_inc] = k
+            n_inc += 1
+    return inc_sta_indices[0:n_inc]
+
+
+@generated_jit(nopython=True, cache=True)
+def _potrf(A):
+    """
+    Cholesky factorization of A in place, single or double precision
+    depending on A. Only the lower triangle of A holds L afterwards, the upper
+    triangle is left as it was
+
+    INPUTS:
+    A- symmetric positive definite matrix, C contiguous
+    OUTPUTS:
+    info- 0 on success, positive if A is not positive definite
+    """
+    if A.dtype == types.float32:
+        potrf = _spotrf
+    else:
+        potrf = _dpotrf
+
+    def impl(A):
+        # A C contiguous lower triangle is the upper triangle in LAPACK's column major order
+        uplo = np.array([_U], np.uint8)
+        n = np.array([A.shape[0]], np.int32)
+        info = np.zeros(1, np.int32)
+        potrf(uplo.ctypes, n.ctypes, A.ctypes, n.ctypes, info.ctypes)
+        return info[0]
+    return impl
+
+
+@generated_jit(nopython=True, cache=True)
+def _trtrs(L, b, trans):
+    """
+    Triangular solve with the factor from _potrf, single or double precision
+    depending on L
+
+    INPUTS:
+    L- Cholesky factor from _potrf
+    b- right hand side, or one right hand side per row
+    trans- _T solves L*y = b, _N solves L.T*y = b
+    OUTPUTS:
+    y- solution, same shape as b
+    """
+    if L.dtype == types.float32:
+        trtrs = _strtrs
+    else:
+        trtrs = _dtrtrs
+
+    def impl(L, b, trans):
+        y = np.ascontiguousarray(b).copy()
+        uplo = np.array([_U], np.uint8)
+        tr = np.array([trans], np.uint8)
+        diag = np.array([_N], np.uint8)
+        n = np.array([L.shape[0]], np.int32)
+        nrhs = np.array([y.size // L.shape[0]], np.int32)
+        info = np.zeros(1, np.int32)
+        trtrs(uplo.ctypes, tr.ctypes, diag.ctypes, n.ctypes, nrhs.ctypes, L.ctypes, n.ctypes, y.ctypes, n.ctypes,
+              info.ctypes)
+        return y
+    return impl
+
+
+@njit(cache=True)
+def _forward(L, b):
+    """
+    Solves L*y = b
+
+    INPUTS:
+    L- Cholesky factor from _potrf
+    b- right hand side, or one right hand side per row
+    OUTPUTS:
+    y- solution
+    """
+    return _trtrs(L, b, _T)
+
+
+@njit(cache=True)
+def _backward(L, y):
+    """
+    Solves L.T*alpha = y
+
+    INPUTS:
+    L- Cholesky factor from _potrf
+    y- right hand side
+    OUTPUTS:
+    alpha- solution
+    """
+    return _trtrs(L, y, _N)
+
+
+@njit(cache=True)
+def _solve_point(correlation_model):
+    """
+    Partitions the correlation matrix and solves for the weights of the
+    conditioning points and the standard deviation of the current point, which
+    is the last row/column
+
+    INPUTS:
+    correlation_model- correlation matrix, current point last
+    OUTPUTS:
+    alpha- Sig12.T*Sig11inv, weights of the conditioning points
+    R- Sqrt of sigma
+    L- Cholesky factor of Sig11
+    y- L^-1*Sig12
+    info- nonzero if Sig11 is not positive definite, the other outputs are
+    then meaningless
+    """
+    n = correlation_model.shape[0] - 1
+    Sig11 = np.ascontiguousarray(correlation_model[0:n, 0:n])
+    Sig12 = np.ascontiguousarray(correlation_model[0:n, n])
+    Sig22 = correlation_model[n, n]
+
+    info = _potrf(Sig11)
+    if info != 0:
+        return Sig12, 0.0, Sig11, Sig12, info
+
+    y = _forward(Sig11, Sig12)
+    alpha = _backward(Sig11, y)
+    sigma = Sig22 - np.dot(y, y)
+
+    return alpha, np.sqrt(sigma), Sig11, y, info
+
+
+@njit(cache=True)
+def _solve_bordered(L, y, R, Css, Csg, cs):
+    """
+    Solves the same system as _solve_point when stations are added in front of
+    grid points that have already been factored. With the grid points first,
+    the Cholesky factor of Sig11 is [[L, 0], [W.T, Ls]] with W = L^-1*Csg.T and
+    Ls the factor of Css - W.T*W, so only the station rows are factored
+
+    INPUTS:
+    L- Cholesky factor of the grid part of Sig11
+    y- L^-1 times the grid part of Sig12
+    R- Sqrt of sigma conditioned on the grid points only
+    Css- station to station correlation
+    Csg- station to grid correlation, current point excluded
+    cs- station to current point correlation
+    OUTPUTS:
+    alpha- Sig12.T*Sig11inv, stations first
+    R- Sqrt of sigma
+    info- nonzero if the station block is not positive definite, the other
+    outputs are then meaningless
+    """
+    k = cs.shape[0]
+    n = y.shape[0]
+
+    Wt = _forward(L, Csg)
+    Ls = Css - np.dot(Wt, Wt.T)
+    alpha = np.empty(k+n, dtype=y.dtype)
+
+    info = _potrf(Ls)
+    if info != 0:
+        return alpha, 0.0, info
+
+    ys = _forward(Ls, cs - np.dot(Wt, y))
+    alpha[0:k] = _backward(Ls, ys)
+    alpha[k:] = _backward(L, y - np.dot(np.ascontiguousarray(Wt.T), alpha[0:k]))
+    sigma = R*R - np.dot(ys, ys)
+
+    return alpha, np.sqrt(sigma), info
+
+
+@njit(cache=True)
+def _realize(grid_arr, mu_arr, offsets, sigma_arr, rand, X):
+    """
+    Fills X with one realization. Conditioning points always come before the
+    current point, so the points are visited in order
+
+    INPUTS:
+    grid_arr, mu_arr, offsets, sigma_arr- output of precompute
+    rand- array of random variables
+    X- output array, same length as sigma_arr
+    """
+    for num in range(sigma_arr.shape[0]):
+        mu = 0.0
+        for k in range(offsets[num], offsets[num+1]):
+            mu += mu_arr[k]*X[grid_arr[k]]
+        X[num] = mu + rand[num]*sigma_arr[num]
+
+
+@njit(parallel=True, cache=True)
+def _realize_many(grid_arr, mu_arr, offsets, sigma_arr, rand):
+    """
+    Computes several realizations in parallel, one per row of rand
+
+    INPUTS:
+    grid_arr, mu_arr, offsets, sigma_arr- output of precompute
+    rand- random variables, one row per realization
+    OUTPUTS:
+    X- spatially correlated epsilon, one row per realization
+    """
+    X = np.empty(rand.shape)
+    for j in prange(rand.shape[0]):
+        _realize(grid_arr, mu_arr, offsets, sigma_arr, rand[j], X[j])
+    return X
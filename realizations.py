@@ -1,6 +1,7 @@
 import numpy as np
+from loop import realize
 
-def realizations(num_realizations, radius, N,M, grid_arr, mu_arr, sigma_arr, uncertaintydata, DATA):
+def realizations(num_realizations, radius, N,M, grid_arr, mu_arr, offsets, sigma_arr, uncertaintydata, DATA):
 
     if num_realizations == 0:
         return
@@ -9,17 +10,20 @@ def realizations(num_realizations, radius, N,M, grid_arr, mu_arr, sigma_arr, unc
         g = open(('workfile_radius_45_100_NRALL_JB'), 'w')
         s = str(num_realizations)
         g.write(s+'\n')
-        rand_arr = np.zeros(M*N)
+        rand_arr = np.zeros([num_realizations, M*N])
+
+        precomp = {'grid_arr':grid_arr, 'mu_arr':mu_arr, 'offsets':offsets, 'sigma_arr':sigma_arr}
 
         for j in range(0, num_realizations):
             for i in range(0,M*N):
-                rand_arr[i] = h.readline()
-            X = np.zeros([M*N,1])
+                rand_arr[j,i] = h.readline()
+
+        # All realizations at once, computed in parallel
+        X_all = realize(precomp, rand_arr)
+
+        for j in range(0, num_realizations):
+            X = X_all[j]
             for i in range(0,M*N):
-                nzeros = np.size(mu_arr[i]) - np.size(grid_arr[i])
-                x = np.append(np.zeros(nzeros), X[np.array(grid_arr[i], dtype = 'i').squeeze()])
-                mu = np.dot(mu_arr[i], x)
-                X[i] = mu + rand_arr[i] * sigma_arr[i]
                 s = str(X[i])
                 g.write(s+'\n')
 
@@ -65,7 +65,7 @@ for R in range(0,np.size(r)):
     if num_realizations > 0:
         print 'Computing realizations'
         realizations(num_realizations, radius, variables['N'], variables['M'], out['grid_arr'], 
-                 out['mu_arr'], out['sigma_arr'], variables['uncertaintydata'], out['data'])
+                 out['mu_arr'], out['offsets'], out['sigma_arr'], variables['uncertaintydata'], out['data'])
 
     if plot_on == True:
         print 'Plotting results'